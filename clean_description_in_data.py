@@ -1,17 +1,20 @@
-import json
-from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor
+import orjson
+from selectolax.lexbor import LexborHTMLParser
+from concurrent.futures import ProcessPoolExecutor
 import os
 
 FOLDER = "output_products"
 
 
 def clean_description(html_text):
-    # Parse HTML
-    soup = BeautifulSoup(html_text, "html.parser")
+    if not html_text:
+        return ""
+
+    # Parse HTML (selectolax/lexbor parse bằng C, nhanh hơn nhiều so với html.parser thuần Python)
+    tree = LexborHTMLParser(html_text)
 
     # Lấy toàn bộ nội dung text, tự loại bỏ tag
-    text = soup.get_text(separator="\n")
+    text = tree.text(separator="\n")
 
     # Loại bỏ khoảng trắng thừa
     lines = [line.strip() for line in text.split("\n") if line.strip()]
@@ -21,19 +24,31 @@ def clean_description(html_text):
 
 
 def process_file(path):
+    """
+    Làm sạch description trong 1 file .json dạng mảng của các lần crawl cũ.
+    File .ndjson mới đã được làm sạch lúc crawl nên không xử lý lại ở đây.
+    """
     print("Xử lý:", path)
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
 
     for item in data:
         item["description"] = clean_description(item.get("description", ""))
 
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # Ghi ra file .tmp rồi os.replace để không bao giờ để lại file ghi dở nếu bị dừng giữa chừng
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, path)
 
-files = [os.path.join(FOLDER, file) for file in os.listdir(FOLDER) if file.endswith(".json")]
+if __name__ == "__main__":
+    # Chỉ file .json cũ; .ndjson do crawler mới ghi đã sạch, làm sạch lại sẽ tốn thêm 1 lượt và có thể làm hỏng text
+    files = [os.path.join(FOLDER, file) for file in os.listdir(FOLDER) if file.endswith(".json")]
 
-with ThreadPoolExecutor(max_workers=5) as exe:
-    exe.map(process_file, files)
+    # Parse HTML + JSON là việc nặng CPU -> dùng process để chạy song song thật sự (không bị GIL)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as exe:
+        # Đọc kết quả để lỗi trong process con (file hỏng, BrokenProcessPool, ...) được raise ra
+        for _ in exe.map(process_file, files):
+            pass
 
-print("Xong toàn bộ!")
+    print("Xong toàn bộ!")
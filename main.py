@@ -1,21 +1,30 @@
-import requests
-import json
+import asyncio
+import httpx
+import orjson
 import time
 import os
-from typing import List, Dict, Any, Optional
+import random
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
 
+from clean_description_in_data import clean_description
 
-API_URL = "https://api.tiki.vn/product-detail/api/v1/products/{product_id}"
+
+API_URL_PREFIX = "https://api.tiki.vn/product-detail/api/v1/products/"  # + product_id
 BATCH_SIZE = 1000 #mỗi file ~1000 sản phẩm
 OUTPUT_DIR = "output_products"
-DELAY_BETWEEN_REQUESTS = 0.1  # giây, để giảm rủi ro bị chặn (10 req/s)
-MAX_WORKERS = 10          # số thread chạy song song
+REQUESTS_PER_SECOND = 50  # giới hạn chung cho mọi request, để giảm rủi ro bị chặn
+MAX_WORKERS = 50          # số request chạy song song tối đa
+INITIAL_WORKERS = 4       # số request song song khởi đầu, tự tăng/giảm theo tỉ lệ lỗi (AIMD)
+MIN_WORKERS = 2           # số request song song tối thiểu khi bị giảm tốc
+ERROR_RATE_THRESHOLD = 0.01  # tỉ lệ 429/5xx trong 1 batch để bắt đầu giảm tốc
+RATELIMIT_REMAINING_THRESHOLD = 5  # x-ratelimit-remaining dưới ngưỡng này thì tạm dừng
+RATELIMIT_PAUSE = 1.0     # giây tạm dừng khi sắp hết quota mà server không gửi Retry-After
 RETRY_TOTAL = 3            # số lần retry tối đa cho 1 request
-fail_product_ids = []
+RETRY_BACKOFF_FACTOR = 1   # delay giữa các lần retry: 1s, 2s, 4s, ...
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_AFTER_DEFAULT = 2.0  # giây chờ khi 429 mà không có header Retry-After
+REQUEST_TIMEOUT = 10        # giây, timeout cho 1 request
 
 #load product Ids
 def load_product_ids_from_csv(path: str):
@@ -37,105 +46,279 @@ def extract_product_fields(raw: Dict[str, Any]) -> Dict[str, Any]:
     Cấu trúc thật sự của API có thể hơi khác -> bạn chỉnh lại nếu cần.
     """
     # Lấy price (tuỳ cấu trúc API)
+    # raw["price"] chỉ lấy 1 lần rồi dùng lại
     price = None
-    if isinstance(raw.get("price"), (int, float, str)):
-        price = raw.get("price")
-    elif isinstance(raw.get("price"), dict):
+    price_raw = raw.get("price")
+    if isinstance(price_raw, (int, float, str)):
+        price = price_raw
+    elif isinstance(price_raw, dict):
         price = (
-            raw["price"].get("value")
-            or raw["price"].get("original_price")
-            or raw["price"].get("final_price")
+            price_raw.get("value")
+            or price_raw.get("original_price")
+            or price_raw.get("final_price")
         )
 
     # Lấy images
     images_url = []
-    images_raw = raw.get("images") or []
+    images_raw = raw.get("images")
     if isinstance(images_raw, list):
-        for img in images_raw:
-            if isinstance(img, dict):
-                url = img.get("base_url") or img.get("url")
-                if url:
-                    images_url.append(url)
+        images_url = [
+            url
+            for img in images_raw
+            if isinstance(img, dict) and (url := img.get("base_url") or img.get("url"))
+        ]
 
     return {
         "id": raw.get("id"),
         "name": raw.get("name"),
         "url_key": raw.get("url_key"),
         "price": price,
-        "description": raw.get("description"),
+        # Làm sạch HTML ngay lúc crawl -> không cần chạy lại clean_description_in_data.py
+        "description": clean_description(raw.get("description")),
         "images": images_url,
     }
 
 
-# ================== HTTP LAYER: SESSION + RETRY ================== #
+# ================== RATE LIMIT: TOKEN BUCKET ================== #
+
+class TokenBucket:
+    """
+    Token bucket dùng chung cho mọi coroutine:
+    - Nạp lại `rate` token mỗi giây, tối đa `capacity` token
+    - Mỗi request lấy 1 token trước khi gửi, hết token thì chờ
+    Chạy trên 1 event loop nên không cần lock.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        """Tạm dừng cấp token cho mọi coroutine trong `seconds` giây."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                # Đang bị tạm dừng (Retry-After / sắp hết quota)
+                wait = self.paused_until - now
+            else:
+                refill_from = max(self.last_refill, self.paused_until)
+                self.tokens = min(self.capacity, self.tokens + (now - refill_from) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+rate_limiter = TokenBucket(REQUESTS_PER_SECOND, MAX_WORKERS)
+
 
-def create_session_with_retry() -> requests.Session:
+# ================== AIMD: TỰ ĐIỀU CHỈNH SỐ REQUEST SONG SONG ================== #
+
+class ConcurrencyController:
+    """
+    Additive-increase / multiplicative-decrease cho số request song song mỗi batch:
+    - Batch ít lỗi (< ERROR_RATE_THRESHOLD) -> tăng thêm 1
+    - Batch nhiều lỗi hoặc có 429 -> giảm một nửa
     """
-    Tạo 1 Session:
-    - Reuse kết nối (connection pool)
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.current = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.total = 0
+        self.errors = 0
+        self.saw_429 = False
+
+    def record(self, status_code: Optional[int]) -> None:
+        """Ghi nhận kết quả 1 request. status_code=None nghĩa là lỗi mạng / timeout."""
+        self.total += 1
+        if status_code == 429:
+            self.saw_429 = True
+            self.errors += 1
+        elif status_code is None or status_code >= 500:
+            self.errors += 1
+
+    def update(self) -> bool:
+        """Cập nhật số request song song sau 1 batch. Trả về True nếu vừa phải giảm tốc."""
+        error_rate = self.errors / self.total if self.total else 0.0
+        backed_off = self.saw_429 or error_rate >= ERROR_RATE_THRESHOLD
+        if backed_off:
+            self.current = max(self.minimum, int(self.current * 0.5))
+        else:
+            self.current = min(self.maximum, self.current + 1)
+        print(f"[AIMD] error_rate={error_rate:.2%}, 429={self.saw_429} -> {self.current} request song song")
+
+        self.total = 0
+        self.errors = 0
+        self.saw_429 = False
+        return backed_off
+
+
+concurrency = ConcurrencyController(INITIAL_WORKERS, MIN_WORKERS, MAX_WORKERS)
+
+
+# ================== HTTP LAYER: CLIENT + RETRY ================== #
+
+def create_client() -> httpx.AsyncClient:
+    """
+    Tạo 1 AsyncClient HTTP/2 (cần `pip install httpx[http2]`):
+    - Chỉ gọi 1 host -> HTTP/2 multiplex mọi request trên cùng 1 kết nối TLS
+    - Giữ kết nối giữa các batch (keepalive_expiry dài hơn delay giữa batch và backoff retry)
     - Gắn sẵn headers
-    - Có retry tự động khi gặp 429 / 5xx / lỗi tạm thời
+    Retry khi gặp 429 / 5xx / lỗi tạm thời được xử lý trong fetch_product_detail.
     """
-    session = requests.Session()
+    # Nếu server không hỗ trợ HTTP/2, httpx quay về HTTP/1.1 -> pool đủ MAX_WORKERS kết nối để không bị nghẽn
+    limits = httpx.Limits(
+        max_connections=MAX_WORKERS,
+        max_keepalive_connections=MAX_WORKERS,
+        keepalive_expiry=30,
+    )
 
     # Header mặc định cho mọi request
-    session.headers.update({
+    # (không gửi "Connection: keep-alive": HTTP/2 cấm header theo kết nối, httpx tự giữ kết nối)
+    headers = {
         "User-Agent": "Mozilla/5.0",
         "Accept": "application/json",
-    })
-
-    # Cấu hình retry
-    retry_strategy = Retry(
-        total=RETRY_TOTAL,
-        backoff_factor=1,                 # delay: 1s, 2s, 4s, ...
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET"],  # các method được retry
-        raise_on_status=False,
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
+    }
 
-    return session
+    return httpx.AsyncClient(http2=True, limits=limits, timeout=REQUEST_TIMEOUT, headers=headers)
 
 
-def fetch_product_detail(session: requests.Session, product_id: str) -> Optional[Dict[str, Any]]:
-    url = API_URL.format(product_id=product_id)
+def pause_if_rate_limited(headers) -> None:
+    """
+    Đọc header rate limit của server:
+    - Có Retry-After (dạng số giây) -> tạm dừng đúng khoảng đó
+    - x-ratelimit-remaining dưới ngưỡng -> tạm dừng RATELIMIT_PAUSE giây
+    """
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            rate_limiter.pause(float(retry_after))
+            return
+        except ValueError:
+            pass  # Retry-After dạng HTTP-date -> bỏ qua
+
+    remaining = headers.get("x-ratelimit-remaining")
+    if remaining is not None:
+        try:
+            if int(remaining) < RATELIMIT_REMAINING_THRESHOLD:
+                rate_limiter.pause(RATELIMIT_PAUSE)
+        except ValueError:
+            pass
+
+
+def retry_after_delay(headers) -> float:
+    """
+    Thời gian chờ trước khi retry 1 request bị 429:
+    Retry-After (giây, mặc định RETRY_AFTER_DEFAULT) nhân jitter ngẫu nhiên 0.5x - 1.5x
+    để các request bị chặn cùng lúc không retry dồn vào cùng 1 thời điểm.
+    """
     try:
-        resp = session.get(url, timeout=10)
-
-        if resp.status_code != 200:
-            # Ghi nhận các lỗi status code khác 200
-            print(f"[WARN] ID {product_id} status {resp.status_code}")
-            fail_product_ids.append(product_id)
-            return None
-
-        data = resp.json()
-        time.sleep(DELAY_BETWEEN_REQUESTS)
-        return extract_product_fields(data)
-
-    except requests.exceptions.Timeout:
-        # Ghi nhận lỗi Timeout rõ ràng
-        print(f"[ERROR] ID {product_id} gặp lỗi Timeout sau {RETRY_TOTAL + 1} lần thử.")
-        return None
-    except requests.exceptions.RequestException as e:
-        # Ghi nhận các lỗi request khác (ConnectionError, HTTPError, ...)
-        print(f"[ERROR] ID {product_id} gặp lỗi RequestException: {e}")
-        return None
-    except Exception as e:
-        # Ghi nhận các lỗi khác (JSONDecodeError, v.v.)
-        print(f"[ERROR] Lỗi không phân loại khi fetch ID {product_id}: {e}")
-        return None
+        retry_after = float(headers.get("Retry-After", RETRY_AFTER_DEFAULT))
+    except ValueError:
+        retry_after = RETRY_AFTER_DEFAULT  # Retry-After dạng HTTP-date
+    return retry_after * (0.5 + random.random())
+
+
+async def fetch_product_detail(client: httpx.AsyncClient, product_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Trả về (product_id, dữ liệu) - dữ liệu là None nếu lỗi, để main ghi nhận ID lỗi."""
+    # Nối chuỗi nhanh hơn str.format (không phải parse template mỗi lần gọi)
+    url = API_URL_PREFIX + str(product_id)
+    for attempt in range(RETRY_TOTAL + 1):
+        # Retry với backoff 1s, 2s, 4s, ... ; riêng 429 thì theo Retry-After + jitter
+        delay = RETRY_BACKOFF_FACTOR * 2 ** attempt
+        try:
+            # Lấy token trước khi gửi request (giới hạn tốc độ toàn cục)
+            await rate_limiter.acquire()
+            resp = await client.get(url)
+            concurrency.record(resp.status_code)
+            pause_if_rate_limited(resp.headers)
+
+            if resp.status_code == 200:
+                # orjson parse thẳng từ bytes, nhanh hơn json chuẩn
+                data = orjson.loads(resp.content)
+                return product_id, extract_product_fields(data)
+
+            if resp.status_code not in RETRY_STATUS_CODES or attempt == RETRY_TOTAL:
+                # Ghi nhận các lỗi status code khác 200
+                print(f"[WARN] ID {product_id} status {resp.status_code}")
+                return product_id, None
+
+            if resp.status_code == 429:
+                delay = retry_after_delay(resp.headers)
+
+        except httpx.TimeoutException:
+            # Ghi nhận lỗi Timeout rõ ràng
+            concurrency.record(None)
+            if attempt == RETRY_TOTAL:
+                print(f"[ERROR] ID {product_id} gặp lỗi Timeout sau {RETRY_TOTAL + 1} lần thử.")
+                return product_id, None
+        except httpx.HTTPError as e:
+            # Ghi nhận các lỗi request khác (ConnectError, RemoteProtocolError, ...)
+            concurrency.record(None)
+            if attempt == RETRY_TOTAL:
+                print(f"[ERROR] ID {product_id} gặp lỗi HTTPError: {e}")
+                return product_id, None
+        except Exception as e:
+            # Ghi nhận các lỗi khác (JSONDecodeError, v.v.)
+            print(f"[ERROR] Lỗi không phân loại khi fetch ID {product_id}: {e}")
+            return product_id, None
+
+        await asyncio.sleep(delay)
+
+    return product_id, None
+
+
+async def fetch_in_window(
+    client: httpx.AsyncClient, product_ids: List[str], limit: int
+) -> AsyncIterator[asyncio.Task]:
+    """
+    Crawl product_ids theo cửa sổ trượt: luôn chỉ có tối đa `limit` task đang chạy,
+    xong task nào thì tạo task mới và yield ngay task vừa xong.
+    Bộ nhớ chỉ O(limit) thay vì tạo sẵn task cho cả batch.
+    Mỗi task trả về (product_id, dữ liệu) nên không cần map task -> product_id.
+    """
+    inflight = set()
+
+    for pid in product_ids:
+        inflight.add(asyncio.create_task(fetch_product_detail(client, pid)))
+
+        if len(inflight) >= limit:
+            done, inflight = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                yield finished
+
+    # Chờ nốt các task còn lại
+    while inflight:
+        done, inflight = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+        for finished in done:
+            yield finished
 
 
 # ================== LƯU FILE THEO BATCH ================== #
 
 def save_batch_to_file(batch_data: List[Dict[str, Any]], batch_index: int) -> None:
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    filename = os.path.join(OUTPUT_DIR, f"products_{batch_index:03d}.json")
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(batch_data, f, ensure_ascii=False, indent=2)
+    # OUTPUT_DIR đã được tạo 1 lần trong main()
+    filename = os.path.join(OUTPUT_DIR, f"products_{batch_index:03d}.ndjson")
+    # NDJSON: mỗi dòng 1 sản phẩm -> file nhỏ hơn bản indent, đọc lại được từng dòng không cần load cả file
+    # orjson luôn ghi UTF-8 (tương đương ensure_ascii=False) và trả về bytes
+    # Ghi ra file .tmp rồi os.replace (atomic): nếu bị dừng giữa chừng thì không có file products_XXX.ndjson ghi dở
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        for item in batch_data:
+            f.write(orjson.dumps(item))
+            f.write(b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
     print(f"Đã lưu {len(batch_data)} sản phẩm vào {filename}")
 
 
@@ -144,7 +327,8 @@ def chunk_iterable(lst: List[Any], size: int):
         yield lst[i:i + size]
 
 
-def main():
+async def main() -> List[str]:
+    """Crawl toàn bộ product_ids, trả về danh sách ID lỗi (fetch trả về None)."""
 
     # TODO: thay bằng chỗ bạn load list id
     # Ví dụ: từ file txt
@@ -153,30 +337,24 @@ def main():
     print(f"Tổng số product_id: {len(product_ids)}")
 
     batch_index = 1
+    fail_product_ids: List[str] = []
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-    # 1 Session duy nhất cho toàn bộ chương trình (reuse connection)
-    session = create_session_with_retry()
+    # 1 Client duy nhất cho toàn bộ chương trình (reuse connection)
+    client = create_client()
 
     try:
         for ids_chunk in chunk_iterable(product_ids, BATCH_SIZE):
             batch_results: List[Dict[str, Any]] = []
 
-            # Multi-thread cho 1 chunk
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                future_to_pid = {
-                    executor.submit(fetch_product_detail, session, pid): pid
-                    for pid in ids_chunk
-                }
-
-                for future in as_completed(future_to_pid):
-                    pid = future_to_pid[future]
-                    try:
-                        data = future.result()
-                        if data is not None:
-                            batch_results.append(data)
-                    except Exception as e:
-                        # Tránh crash toàn bộ nếu 1 thread lỗi
-                        print(f"[ERROR] Lỗi không mong đợi với ID {pid}: {e}")
+            # Chạy song song 1 chunk trên event loop, số request song song do AIMD quyết định
+            async for task in fetch_in_window(client, ids_chunk, concurrency.current):
+                # fetch_product_detail tự bắt mọi Exception và luôn trả về (product_id, dữ liệu)
+                pid, data = task.result()
+                if data is not None:
+                    batch_results.append(data)
+                else:
+                    fail_product_ids.append(pid)
 
             if batch_results:
                 save_batch_to_file(batch_results, batch_index)
@@ -184,17 +362,19 @@ def main():
                 print(f"[WARN] Chunk batch_index={batch_index} không có sản phẩm hợp lệ.")
 
             batch_index += 1
-            #delay giữa các batch, tránh lỗi 429
-            time.sleep(2)
+            # Chỉ delay giữa các batch khi vừa bị giảm tốc (nhiều lỗi / 429)
+            if concurrency.update():
+                await asyncio.sleep(2)
     finally:
-        session.close()
+        await client.aclose()
 
     print("Hoàn thành!")
+    return fail_product_ids
 
 
 if __name__ == "__main__":
     start_time = time.time()
-    main()
+    fail_product_ids = asyncio.run(main())
     print("--- %s seconds ---" % (time.time() - start_time))
 
     print(f"Số sản phẩm không thành công = {len(fail_product_ids)}")
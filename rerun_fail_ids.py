@@ -1,19 +1,21 @@
 import requests
-import json
+import orjson
 import time
 import os
-from typing import List, Dict, Any, Optional
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
+import random
+from collections import deque
+from typing import List, Dict, Any, Optional, Tuple, Deque
 
-API_URL = "https://api.tiki.vn/product-detail/api/v1/products/{product_id}"
+from clean_description_in_data import clean_description
+
+API_URL_PREFIX = "https://api.tiki.vn/product-detail/api/v1/products/"  # + product_id
 BATCH_SIZE = 1000        # mỗi file ~1000 sản phẩm
 OUTPUT_DIR = "output_products"
-DELAY_BETWEEN_REQUESTS = 0.1  # giây, để giảm rủi ro bị chặn (10 req/s)
-RETRY_TOTAL = 3          # số lần retry tối đa cho 1 request
-
-# Global list lưu các ID lỗi cho từng vòng chạy
-fail_product_ids: List[str] = []
+REQUESTS_PER_SECOND = 10  # giới hạn tốc độ gửi request, để giảm rủi ro bị chặn
+RETRY_AFTER_DEFAULT = 2.0  # giây chờ khi 429 mà không có header Retry-After
+MAX_ATTEMPTS = 3         # số request tối đa cho 1 ID trước khi ghi vào fail_ids_rerun.txt
+RETRY_BASE_DELAY = 2.0   # giây, backoff cho ID lỗi: base * 2**attempts + jitter
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}  # lỗi tạm thời -> đưa ID lại hàng đợi
 
 
 # =============== LOAD PRODUCT IDS TỪ TXT =============== #
@@ -42,43 +44,72 @@ def extract_product_fields(raw: Dict[str, Any]) -> Dict[str, Any]:
     """
     # Lấy price (tuỳ cấu trúc API)
     price = None
-    if isinstance(raw.get("price"), (int, float, str)):
-        price = raw.get("price")
-    elif isinstance(raw.get("price"), dict):
+    price_raw = raw.get("price")
+    if isinstance(price_raw, (int, float, str)):
+        price = price_raw
+    elif isinstance(price_raw, dict):
         price = (
-            raw["price"].get("value")
-            or raw["price"].get("original_price")
-            or raw["price"].get("final_price")
+            price_raw.get("value")
+            or price_raw.get("original_price")
+            or price_raw.get("final_price")
         )
 
     # Lấy images
     images_url = []
-    images_raw = raw.get("images") or []
+    images_raw = raw.get("images")
     if isinstance(images_raw, list):
-        for img in images_raw:
-            if isinstance(img, dict):
-                url = img.get("base_url") or img.get("url")
-                if url:
-                    images_url.append(url)
+        images_url = [
+            url
+            for img in images_raw
+            if isinstance(img, dict) and (url := img.get("base_url") or img.get("url"))
+        ]
 
     return {
         "id": raw.get("id"),
         "name": raw.get("name"),
         "url_key": raw.get("url_key"),
         "price": price,
-        "description": raw.get("description"),
+        # Làm sạch HTML ngay lúc crawl -> không cần chạy lại clean_description_in_data.py
+        "description": clean_description(raw.get("description")),
         "images": images_url,
     }
 
 
-# =============== HTTP LAYER: SESSION + RETRY =============== #
+# =============== RATE LIMIT: GIÃN CÁCH REQUEST =============== #
 
-def create_session_with_retry() -> requests.Session:
+class RequestPacer:
+    """
+    Giãn cách các request (chạy đơn luồng): mỗi request cách nhau ít nhất 1 / rate giây.
+    Chỉ chờ phần còn thiếu, nên request chậm sẵn (RTT dài) không phải chờ thêm.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_send_time = 0.0
+
+    def pause(self, seconds: float) -> None:
+        """Không gửi request nào trong `seconds` giây tới (vd. khi server trả 429)."""
+        self.next_send_time = max(self.next_send_time, time.monotonic() + seconds)
+
+    def acquire(self) -> None:
+        now = time.monotonic()
+        if now < self.next_send_time:
+            time.sleep(self.next_send_time - now)
+            now = self.next_send_time
+        self.next_send_time = now + self.interval
+
+
+rate_limiter = RequestPacer(REQUESTS_PER_SECOND)
+
+
+# =============== HTTP LAYER: SESSION =============== #
+
+def create_session() -> requests.Session:
     """
     Tạo 1 Session:
     - Reuse kết nối (connection pool)
     - Gắn sẵn headers
-    - Có retry tự động khi gặp 429 / 5xx / lỗi tạm thời
+    Không cấu hình retry: hàng đợi trong main là lớp retry duy nhất (mỗi lần thử = 1 request).
     """
     session = requests.Session()
 
@@ -86,78 +117,89 @@ def create_session_with_retry() -> requests.Session:
     session.headers.update({
         "User-Agent": "Mozilla/5.0",
         "Accept": "application/json",
+        "Connection": "keep-alive",
     })
 
-    # Cấu hình retry
-    retry_strategy = Retry(
-        total=RETRY_TOTAL,
-        backoff_factor=1,                 # delay: 1s, 2s, 4s, ...
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET"],          # các method được retry
-        raise_on_status=False,
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    return session
 
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
 
-    return session
+def retry_after_delay(headers) -> float:
+    """
+    Thời gian tạm dừng gửi request sau khi bị 429:
+    Retry-After (giây, mặc định RETRY_AFTER_DEFAULT) nhân jitter ngẫu nhiên 0.5x - 1.5x
+    để các request bị chặn cùng lúc không retry dồn vào cùng 1 thời điểm.
+    """
+    try:
+        retry_after = float(headers.get("Retry-After", RETRY_AFTER_DEFAULT))
+    except ValueError:
+        retry_after = RETRY_AFTER_DEFAULT  # Retry-After dạng HTTP-date
+    return retry_after * (0.5 + random.random())
 
 
-def fetch_product_detail(session: requests.Session, product_id: str) -> Optional[Dict[str, Any]]:
+def fetch_product_detail(
+    session: requests.Session, product_id: str
+) -> Tuple[Optional[Dict[str, Any]], bool]:
     """
-    Gọi API lấy chi tiết 1 sản phẩm.
-    Nếu lỗi hoặc status != 200:
-      - log ra
-      - thêm product_id vào fail_product_ids
-      - return None
+    Gọi API lấy chi tiết 1 sản phẩm, đúng 1 request (không tự retry).
+    Trả về (dữ liệu, retryable):
+      - dữ liệu = None nếu lỗi (đã log ra)
+      - retryable = True nếu lỗi tạm thời (429 / 5xx / timeout / lỗi mạng), main đưa ID lại hàng đợi
     """
-    url = API_URL.format(product_id=product_id)
+    # Nối chuỗi nhanh hơn str.format (không phải parse template mỗi lần gọi)
+    url = API_URL_PREFIX + str(product_id)
     try:
+        # Giãn cách request thay cho sleep sau mỗi request
+        rate_limiter.acquire()
         resp = session.get(url, timeout=10)
 
+        if resp.status_code == 429:
+            # Server yêu cầu chậm lại -> tạm dừng mọi request theo Retry-After + jitter
+            rate_limiter.pause(retry_after_delay(resp.headers))
+
         if resp.status_code != 200:
             print(f"[WARN] ID {product_id} status {resp.status_code}")
-            fail_product_ids.append(product_id)
-            return None
+            return None, resp.status_code in RETRY_STATUS_CODES
 
-        data = resp.json()
-        # Delay nhỏ giữa các request để giảm nguy cơ bị chặn
-        time.sleep(DELAY_BETWEEN_REQUESTS)
-        return extract_product_fields(data)
+        # orjson parse thẳng từ bytes (resp.content), bỏ qua bước decode resp.text
+        data = orjson.loads(resp.content)
+        return extract_product_fields(data), False
 
     except requests.exceptions.Timeout:
-        print(f"[ERROR] ID {product_id} gặp lỗi Timeout sau {RETRY_TOTAL + 1} lần thử.")
-        fail_product_ids.append(product_id)
-        return None
+        print(f"[ERROR] ID {product_id} gặp lỗi Timeout.")
+        return None, True
     except requests.exceptions.RequestException as e:
         print(f"[ERROR] ID {product_id} gặp lỗi RequestException: {e}")
-        fail_product_ids.append(product_id)
-        return None
+        return None, True
     except Exception as e:
+        # Lỗi không phải do mạng (JSONDecodeError, v.v.) -> retry cũng không khỏi
         print(f"[ERROR] Lỗi không phân loại khi fetch ID {product_id}: {e}")
-        fail_product_ids.append(product_id)
-        return None
+        return None, False
 
 
 # =============== LƯU FILE THEO BATCH =============== #
 
 def save_batch_to_file(batch_data: List[Dict[str, Any]], batch_index: int) -> None:
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    filename = os.path.join(OUTPUT_DIR, f"products_{batch_index:03d}.json")
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(batch_data, f, ensure_ascii=False, indent=2)
+    # OUTPUT_DIR đã được tạo 1 lần trong main()
+    filename = os.path.join(OUTPUT_DIR, f"products_{batch_index:03d}.ndjson")
+    # NDJSON: mỗi dòng 1 sản phẩm -> file nhỏ hơn bản indent, đọc lại được từng dòng không cần load cả file
+    # orjson luôn ghi UTF-8 (tương đương ensure_ascii=False) và trả về bytes
+    # Ghi ra file .tmp rồi os.replace: nếu bị dừng giữa chừng thì không có file products_XXX.ndjson ghi dở,
+    # get_last_batch_index vẫn đúng khi chạy lại
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        for item in batch_data:
+            f.write(orjson.dumps(item))
+            f.write(b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
     print(f"Đã lưu {len(batch_data)} sản phẩm vào {filename}")
 
 
-def chunk_iterable(lst: List[Any], size: int):
-    """Cắt list thành các chunk size phần tử."""
-    for i in range(0, len(lst), size):
-        yield lst[i:i + size]
-
 def get_last_batch_index(folder: str) -> int:
     """
-    Trả về batch index *tiếp theo* dựa trên các file products_XXX.json trong folder.
+    Trả về batch index *tiếp theo* dựa trên các file products_XXX.ndjson
+    (hoặc products_XXX.json của các lần crawl cũ) trong folder.
     Nếu folder trống → trả về 1.
     """
     if not os.path.exists(folder):
@@ -165,9 +207,10 @@ def get_last_batch_index(folder: str) -> int:
 
     max_index = 0
     for filename in os.listdir(folder):
-        if filename.startswith("products_") and filename.endswith(".json"):
+        name, ext = os.path.splitext(filename)
+        if name.startswith("products_") and ext in (".ndjson", ".json"):
             try:
-                index = int(filename.replace("products_", "").replace(".json", ""))
+                index = int(name.replace("products_", ""))
                 max_index = max(max_index, index)
             except:
                 pass
@@ -178,79 +221,77 @@ def get_last_batch_index(folder: str) -> int:
 
 # =============== MAIN: ĐƠN LUỒNG, NHẬN FILE INPUT =============== #
 
-def main(input_file: str):
+def main(input_file: str) -> List[str]:
     """
-    Chạy crawl 1 vòng:
-    - Đọc product_ids từ input_file
-    - Crawl từng ID
-    - Lưu output theo batch
-    - Cập nhật global fail_product_ids
+    Crawl lại các ID trong input_file trong 1 vòng duy nhất:
+    - Hàng đợi (deque) chứa (product_id, next_attempt_time, attempts)
+    - ID lỗi tạm thời (429 / 5xx / timeout / lỗi mạng) được đẩy lại cuối hàng đợi
+      với backoff base * 2**attempts + jitter, các ID khác vẫn chạy tiếp không phải chờ hết 1 vòng
+    - ID lỗi cố định (404, dữ liệu hỏng, ...) ghi nhận lỗi ngay, không retry
+    - Đây là lớp retry duy nhất: mỗi lần thử đúng 1 request, tối đa MAX_ATTEMPTS request / ID
+    - Lưu output theo batch mỗi khi đủ BATCH_SIZE sản phẩm
+    - Trả về danh sách ID vẫn lỗi sau MAX_ATTEMPTS lần thử
     """
     product_ids = load_product_ids_from_txt(input_file)
     print(f"[RUN] Input file: {input_file}, tổng số product_id: {len(product_ids)}")
 
     batch_index = get_last_batch_index(OUTPUT_DIR)
     print(f"Khởi động với batch_index = {batch_index}")
-    session = create_session_with_retry()
-
-    try:
-        for ids_chunk in chunk_iterable(product_ids, BATCH_SIZE):
-            batch_results: List[Dict[str, Any]] = []
-
-            print(f"=== Bắt đầu batch {batch_index}, số ID: {len(ids_chunk)} ===")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    session = create_session()
 
-            for pid in ids_chunk:
-                data = fetch_product_detail(session, pid)
-                if data is not None:
-                    batch_results.append(data)
+    pending: Deque[Tuple[str, float, int]] = deque((pid, 0.0, 0) for pid in product_ids)
+    batch_results: List[Dict[str, Any]] = []
+    fail_product_ids: List[str] = []
 
-            if batch_results:
-                save_batch_to_file(batch_results, batch_index)
+    try:
+        while pending:
+            pid, next_attempt_time, attempts = pending.popleft()
+
+            # ID lỗi nằm cuối hàng đợi theo thứ tự thời gian retry -> chỉ cần chờ ID đầu hàng
+            wait = next_attempt_time - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            data, retryable = fetch_product_detail(session, pid)
+            if data is not None:
+                batch_results.append(data)
+                if len(batch_results) >= BATCH_SIZE:
+                    save_batch_to_file(batch_results, batch_index)
+                    batch_index += 1
+                    batch_results = []
+                continue
+
+            attempts += 1
+            if not retryable or attempts >= MAX_ATTEMPTS:
+                fail_product_ids.append(pid)
             else:
-                print(f"[WARN] Batch {batch_index} không có sản phẩm hợp lệ.")
+                delay = RETRY_BASE_DELAY * 2 ** attempts + random.uniform(0, RETRY_BASE_DELAY)
+                pending.append((pid, time.monotonic() + delay, attempts))
 
-            print(f"=== Kết thúc batch {batch_index}, đã ghi {len(batch_results)} sản phẩm ===")
-            batch_index += 1
-
-            # Delay giữa các batch, tránh bị 429
-            time.sleep(2)
+        if batch_results:
+            save_batch_to_file(batch_results, batch_index)
 
     finally:
         session.close()
 
-    print("Hoàn thành 1 vòng crawl!")
-
+    print("Hoàn thành crawl lại!")
+    return fail_product_ids
 
-# =============== VÒNG LẶP NHIỀU LẦN =============== #
 
 if __name__ == "__main__":
-    NUM_RUNS = 3
-
-    current_input = "fail_ids.txt"
-
-    for iteration in range(1, NUM_RUNS + 1):
-        print(f"\n===== BẮT ĐẦU VÒNG {iteration}, input = {current_input} =====")
-
-        # Reset danh sách fail cho vòng này
-        fail_product_ids.clear()
-
-        start_time = time.time()
-        main(current_input)
-        crawl_time = time.time() - start_time
-
-        print(f"--- Thời gian vòng {iteration}: {crawl_time:.2f} giây ---")
-        print(f"Số sản phẩm không thành công ở vòng {iteration} = {len(fail_product_ids)}")
-
-        # Ghi đè fail_ids.txt bằng các ID lỗi của vòng này
-        with open("fail_ids_rerun.txt", "w", encoding="utf-8") as f:
-            f.write(f"--- Thời gian vòng {iteration}: {crawl_time:.2f} giây ---\n")
-            f.write(f"Số sản phẩm không thành công ở vòng {iteration} = {len(fail_product_ids)}\n")
-            for pid in fail_product_ids:
-                f.write(f"{pid}\n")
+    start_time = time.time()
+    fail_product_ids = main("fail_ids.txt")
+    crawl_time = time.time() - start_time
 
-        print(f"Đã lưu {len(fail_product_ids)} ID lỗi vào fail_ids.txt")
-        # Các vòng sau luôn dùng fail_ids.txt làm input
-        current_input = "fail_ids_rerun.txt"
+    print(f"--- Thời gian crawl lại: {crawl_time:.2f} giây ---")
+    print(f"Số sản phẩm không thành công sau {MAX_ATTEMPTS} lần thử = {len(fail_product_ids)}")
 
+    # Giữ 2 dòng header giống fail_ids.txt để có thể dùng lại làm input
+    with open("fail_ids_rerun.txt", "w", encoding="utf-8") as f:
+        f.write(f"--- Thời gian crawl lại: {crawl_time:.2f} giây ---\n")
+        f.write(f"Số sản phẩm không thành công sau {MAX_ATTEMPTS} lần thử = {len(fail_product_ids)}\n")
+        for pid in fail_product_ids:
+            f.write(f"{pid}\n")
 
-    print("\n===== HOÀN TẤT TẤT CẢ CÁC VÒNG =====")
+    print(f"Đã lưu {len(fail_product_ids)} ID lỗi vào fail_ids_rerun.txt")